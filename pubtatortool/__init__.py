@@ -1,2 +1,3 @@
 from .pubtator_document import PubTatorDocument
 from .pubtator_corpus import PubTatorCorpus
+from .pubtator_corpus import parse_documents
@@ -1,20 +1,114 @@
+import mmap
+import multiprocessing
+import os
+
+from collections import Counter
+
 from .pubtator_document import PubTatorDocument
+from .pubtator_document import UMLS_Entity
+from .pubtator_document import text_preprocess
 from .tokenization import WordTokenizer
 
 
-def peek(file, n=1):
-    """ Reads n lines ahead in a file without changing the file
-        object's current position in the file
+def _iter_doc_blocks(fname):
+    """ Yields the lines of each document of a PubTator-formatted
+        file, one document at a time. Documents are separated by a
+        blank line; within a document, the title and abstract lines
+        come first, then one entity mention per line.
+        The file is memory-mapped rather than read, so the kernel
+        pages it in as the split progresses instead of the whole dump
+        being copied into a Python string first.
+    """
+    with open(fname, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped, and holds no documents
+            return
+        with mapped:
+            pos = 0
+            end = len(mapped)
+            while pos < end:
+                boundary = mapped.find(b'\n\n', pos)
+                if boundary == -1:
+                    boundary = end
+                block = mapped[pos:boundary]
+                pos = boundary + 2
+                lines = [line.decode() for line in block.split(b'\n')
+                         if line]
+                if lines:
+                    yield lines
+
+
+def _batch_tokenize(doc_blocks, tokenizer):
+    """ Tokenizes the raw text of every document in one batched call
+        when the tokenizer supports it. Huggingface fast tokenizers
+        process a batch of texts in the Rust backend, which is far
+        cheaper than one Python-level call per document.
+        Args:
+            - doc_blocks (list<list<str>>): the lines of each document
+            - tokenizer: the corpus tokenizer
+        Return:
+            - a list with one (tokens, spans) pair per document, or
+                None if the tokenizer cannot batch.
+    """
+    if not getattr(tokenizer, 'is_fast', False):
+        return None
+    raw_texts = []
+    for lines in doc_blocks:
+        _, title = text_preprocess(lines[0])
+        _, abstract = text_preprocess(lines[1])
+        # same concatenation as PubTatorDocument.raw_text
+        raw_texts.append(title + '\n' + abstract)
+    encodings = tokenizer(raw_texts, add_special_tokens=False,
+                          return_offsets_mapping=True)
+    return [(tokenizer.convert_ids_to_tokens(input_ids), offsets)
+            for input_ids, offsets in zip(encodings['input_ids'],
+                                          encodings['offset_mapping'])]
+
+
+def parse_documents(doc_blocks, tokenizer):
+    """ Builds PubTatorDocument objects from pre-split document
+        blocks, batching whatever work can span the whole batch:
+        tokenization of all raw texts happens in one call when the
+        tokenizer supports it, and each document is then constructed
+        from its precomputed tokens. Stateless, so callers are free to
+        shard a corpus into batches however they like.
+        Args:
+            - doc_blocks (list<list<str>>): the lines of each
+                document, stripped of blank lines
+            - tokenizer: the tokenizer passed on to each document
+        Return:
+            - documents (list<PubTatorDocument>)
+    """
+    if not doc_blocks:
+        # fast tokenizers choke on an empty batch, and there is
+        # nothing to build anyway
+        return []
+    pretokenized = _batch_tokenize(doc_blocks, tokenizer)
+    if pretokenized is None:
+        pretokenized = [None] * len(doc_blocks)
+
+    documents = []
+    for lines, pretok in zip(doc_blocks, pretokenized):
+        title, abstract, *mentions = lines
+        documents.append(PubTatorDocument(title, abstract, mentions,
+                                          tokenizer,
+                                          pretokenized=pretok))
+    return documents
+
+
+def _parse_file(fname, tokenizer):
+    """ Parses a single PubTator-formatted file into a list of
+        PubTatorDocument objects. Module-level so it can be dispatched
+        to worker processes by PubTatorCorpus._init_documents.
         Args:
-            - file: a text file
-            - n (int): how many lines ahead should be read, defaults to 1
+            - fname (str): name of the file to parse
+            - tokenizer: the tokenizer passed on to each document
         Return:
-            - line: last line read
+            - documents (list<PubTatorDocument>)
     """
-    pos = file.tell()
-    lines = [file.readline() for i in range(n)]
-    file.seek(pos)
-    return lines[-1]
+    return parse_documents(list(_iter_doc_blocks(fname)), tokenizer)
 
 
 class PubTatorCorpus:
@@ -28,7 +122,8 @@ class PubTatorCorpus:
             tokenization: a TokenType (the same as its tokenizer)
             n_documents: The number of documents in the corpus
             document_list: a list containing all of the documents as
-                PubTatorDocument objects.
+                PubTatorDocument objects, or None for a lazy corpus,
+                in which case documents() parses them on demand.
             cuids: a dict with all of the CUIs that appear in the corpus
                 as keys, and their number of occurences as values
             stids: a dict with all of the STIs that appear in the corpus
@@ -37,7 +132,7 @@ class PubTatorCorpus:
             nconcepts: total number of CUIs in the corpus.
     """
 
-    def __init__(self, fnames, tokenizer=None):
+    def __init__(self, fnames, tokenizer=None, lazy=False):
         """ Args:
                 - fnames (list<str>): list of filenames in the corpus
                 - auto_looping (bool): whether retrieving documents should
@@ -46,68 +141,108 @@ class PubTatorCorpus:
                     `tokenization_tools.WordTokenizer`). A tokenizer that
                     implements a `tokenize()` method and has a `tokenization`
                     attribute of type `tokenization_tools.TokenType`.
+                - lazy (bool): if True, documents are parsed on demand
+                    by documents() instead of all being kept in memory,
+                    so memory usage stays constant in the corpus size.
+                    document_list is then None, and corpus statistics
+                    come from a light prescan of the files.
         """
 
         self._filenames = fnames
-        self._currentfile = 0
+        self._lazy = lazy
 
         self.tokenizer = tokenizer or WordTokenizer(None)
         self.tokenization = self.tokenizer.tokenization
-        self._init_documents()
-        self.n_documents = len(self.document_list)
-
-        self.cuids, self.stids, self.vocab = self._get_cuids_and_vocab()
+        if lazy:
+            self.document_list = None
+            (self.n_documents, self.cuids,
+             self.stids, self.vocab) = self._prescan()
+        else:
+            self._init_documents()
+            self.n_documents = len(self.document_list)
+            self.cuids, self.stids, self.vocab =\
+                self._get_cuids_and_vocab()
         self.nconcepts = len(self.cuids)
 
+    def _prescan(self):
+        """ Streams over the corpus files once to collect the document
+            count, CUID/STID tallies and vocabulary, without building
+            (or keeping) any PubTatorDocument. Only the entity lines
+            are parsed and only the raw text is tokenized; sentence
+            splitting and target alignment are skipped entirely.
+        """
+        n_documents = 0
+        cuids = Counter()
+        stids = Counter()
+        vocab = set()
+        for fname in self._filenames:
+            for lines in _iter_doc_blocks(fname):
+                n_documents += 1
+                _, title = text_preprocess(lines[0])
+                _, abstract = text_preprocess(lines[1])
+                vocab.update(self.tokenizer.tokenize(
+                    title + '\n' + abstract))
+                entities = [UMLS_Entity(line) for line in lines[2:]]
+                cuids.update(e.cui for e in entities)
+                stids.update(e.semantic_type_ID for e in entities)
+        return n_documents, cuids, stids, vocab
+
     def _get_cuids_and_vocab(self):
         """ Collects the CUIDs, STIDs and vocabulary of the corpus.
             Should not be used outside of the constructor, because
             it relies on the document counter being at the start.
             If you need CUIDs or vocab, use the appropriate attributes.
         """
-        cuids = {}
-        stids = {}
+        cuids = Counter()
+        stids = Counter()
         vocab = set()
         for document in self.document_list:
-            for entity in document.umls_entities:
-                if entity.cui in cuids:
-                    cuids[entity.cui] += 1
-                else:
-                    cuids[entity.cui] = 1
-                if entity.semantic_type_ID in stids:
-                    stids[entity.semantic_type_ID] += 1
-                else:
-                    stids[entity.semantic_type_ID] = 1
-            vocab = vocab.union(document.get_vocab())
+            # Counter.update does the per-entity tallying in C, with a
+            # single lookup per increment
+            cuids.update(e.cui for e in document.umls_entities)
+            stids.update(e.semantic_type_ID
+                         for e in document.umls_entities)
+            # in-place update straight from the token list: no
+            # intermediate per-document set, no freshly allocated
+            # union set per iteration
+            vocab.update(document.text)
         return cuids, stids, vocab
 
     def _init_documents(self):
-        self.document_list = []
-        while self._currentfile < len(self._filenames):
-            # opening the file -- not using `with` because
-            # it causes excessive indentation
-            f = open(self._filenames[self._currentfile], 'r')
-
-            next_line = None
-            while next_line != '' and peek(f) != '':
-                title = f.readline()
-                abstract = f.readline()
-                next_line = f.readline()
-
-                # after the abstract, each entity mention is written on a
-                # separate line. The next document comes after a newline.
-                umls_entities = []
-                while next_line != '\n' and next_line != '':
-                    # [:-1] deletes the trailing newline character
-                    umls_entities.append(next_line[:-1])
-                    next_line = f.readline()
-
-                self.document_list.append(PubTatorDocument(title, abstract,
-                                                           umls_entities,
-                                                           self.tokenizer))
-            f.close()
-
-            self._currentfile += 1
+        """ Parses every file of the corpus into PubTatorDocument
+            objects. Document construction is CPU-bound (sentence
+            splitting, tokenization, target alignment), so the work is
+            spread over a pool of worker processes: one file per worker
+            when the corpus spans several files, and for a single file
+            -- often one huge concatenated dump -- one chunk of its
+            documents per core.
+        """
+        n_cpus = os.cpu_count() or 1
+        if not self._filenames:
+            self.document_list = []
+            return
+        if len(self._filenames) > 1:
+            args = [(fname, self.tokenizer) for fname in self._filenames]
+            with multiprocessing.Pool(
+                    processes=min(n_cpus, len(args))) as pool:
+                doc_lists = pool.starmap(_parse_file, args)
+        else:
+            doc_blocks = list(_iter_doc_blocks(self._filenames[0]))
+            n_chunks = min(n_cpus, len(doc_blocks))
+            if n_chunks <= 1:
+                # a pool is pure overhead for a lone document (or an
+                # empty file), as is one on a single-core machine
+                self.document_list = parse_documents(doc_blocks,
+                                                     self.tokenizer)
+                return
+            # ceiling division so the last chunk is never empty
+            chunk_size = (len(doc_blocks) + n_chunks - 1) // n_chunks
+            args = [(doc_blocks[i:i + chunk_size], self.tokenizer)
+                    for i in range(0, len(doc_blocks), chunk_size)]
+            with multiprocessing.Pool(processes=len(args)) as pool:
+                doc_lists = pool.starmap(parse_documents, args)
+        self.document_list = [doc for docs in doc_lists
+                              for doc in docs]
 
     def documents(self):
         """ Yields a document containing:
@@ -116,6 +251,14 @@ class PubTatorCorpus:
                 - abstract (str): the next document's abstract
                 - umls_entities (list<str>): list of UMLS entities
                     for the next document
+            In a lazy corpus, each document is parsed as it is
+            requested and discarded once the caller lets go of it.
         """
-        for document in self.document_list:
-            yield document
+        if self.document_list is not None:
+            yield from self.document_list
+            return
+        for fname in self._filenames:
+            for lines in _iter_doc_blocks(fname):
+                title, abstract, *mentions = lines
+                yield PubTatorDocument(title, abstract, mentions,
+                                       self.tokenizer)
@@ -1,6 +1,25 @@
-import itertools
 import nltk
-from diff_match_patch import diff_match_patch
+import numpy as np
+
+
+# module-level cache for the punkt sentence tokenizer, which is a
+# large pickle that should only be loaded from disk once per process
+# rather than once per document.
+_SENT_TOK = None
+
+
+def _get_sent_tok():
+    """ Returns the punkt sentence tokenizer, loading it on first use
+        (and downloading it beforehand if it is not available locally).
+    """
+    global _SENT_TOK
+    if _SENT_TOK is None:
+        try:
+            _SENT_TOK = nltk.data.load('tokenizers/punkt/english.pickle')
+        except LookupError:
+            nltk.download('punkt')
+            _SENT_TOK = nltk.data.load('tokenizers/punkt/english.pickle')
+    return _SENT_TOK
 
 
 def text_preprocess(text):
@@ -14,15 +33,14 @@ def text_preprocess(text):
             pmid (str): PMID of the article, of 1 to 8 digits
             text (str): cleaned text
     """
-    # separating PMID and letter from the text.
-    # *text captures the rest of the list in case
-    # there happens to be a | in the text.
-    pmid, _, *text = text.split("|")
-    # joining the various fields of the title in case there
-    # happens to be a | in the title text; removing \n
-    text = "|".join(text)[:-1]
-
-    return pmid, text
+    # separating PMID and letter from the text. partition only cuts at
+    # the first separator, so any | in the text itself is left alone --
+    # no list to build and re-join as with split.
+    pmid, _, rest = text.partition('|')
+    _, _, text = rest.partition('|')
+    # removing the trailing newline if the line came straight out
+    # of a file
+    return pmid, text.rstrip('\n')
 
 
 class UMLS_Entity:
@@ -32,16 +50,22 @@ class UMLS_Entity:
 
     def __init__(self, text):
         self._orig_text = text
-        # The first field that is ignored is the PMID of the document.
-        (_, self.start_idx, self.stop_idx, self.mention_text,
-         self.semantic_type_ID, self.cui) = text.split('\t')
+        # Successive partitions peel the fields off one tab at a time
+        # without allocating a list, and a stray tab in the last field
+        # cannot break the unpacking the way split('\t') could.
+        # The first field, the PMID of the document, is ignored.
+        _, _, rest = text.rstrip('\n').partition('\t')
+        start_idx, _, rest = rest.partition('\t')
+        stop_idx, _, rest = rest.partition('\t')
+        self.mention_text, _, rest = rest.partition('\t')
+        self.semantic_type_ID, _, cui = rest.partition('\t')
 
         # The CUI may be formatted as "C0123456" or "UMLS:C0123456".
         # We want to chop off the "UMLS:" if applicable.
-        self.cui = self.cui.split(':')[-1]
+        self.cui = cui.rpartition(':')[2]
 
-        self.start_idx = int(self.start_idx)
-        self.stop_idx = int(self.stop_idx)
+        self.start_idx = int(start_idx)
+        self.stop_idx = int(stop_idx)
 
     def __str__(self):
         return self._orig_text
@@ -52,7 +76,6 @@ class PubTatorDocument:
         using the information provided in the PubTator format.
         Attr:
             abstract (str): Abstract of the article
-            char_level_targets
             pmid (str): PMID of the document
             raw_text (str): simple concatenation of title and abstract. The
                 indexing of characters in raw_text matches the one used in
@@ -66,7 +89,10 @@ class PubTatorDocument:
             targets
             text (list<str>): title fused with abstract but as a list of tokens
             title (str): Title of the article
-            token_to_char_lookup
+            token_char_starts (numpy.ndarray<int32>): index in raw_text
+                of the first character of each token
+            token_char_ends (numpy.ndarray<int32>): index in raw_text
+                one past the last character of each token
             tokenization
             tokenizer
             umls_entities (list<UMLS_Entity>): list of UMLS entity
@@ -74,13 +100,18 @@ class PubTatorDocument:
             vocab
     """
 
-    def __init__(self, title, abstract, mentions, tokenizer):
+    def __init__(self, title, abstract, mentions, tokenizer,
+                 pretokenized=None):
         """ Args:
                 - (str) title: raw title line of text
                 - (str) abstract: raw abstract line of text
                 - (list<str>) mentions: list of raw lines
                     of text containing the UMLS entity mentions.
                 - tokenizer: TODO.
+                - pretokenized: optional (tokens, spans) pair for the
+                    raw text, as produced by batch tokenization in
+                    PubTatorCorpus. When given, the raw text is not
+                    re-tokenized here.
         """
         self.pmid, self.title = text_preprocess(title)
         _, self.abstract = text_preprocess(abstract)
@@ -90,11 +121,7 @@ class PubTatorDocument:
         self.umls_entities = [UMLS_Entity(entity) for entity in mentions]
         self.tokenizer = tokenizer
 
-        try:
-            sentence_tok = nltk.data.load('tokenizers/punkt/english.pickle')
-        except LookupError:
-            nltk.download('punkt')
-            sentence_tok = nltk.data.load('tokenizers/punkt/english.pickle')
+        sentence_tok = _get_sent_tok()
 
         # We get a list of (start_idx, end_idx) pairs for each sentence
         self.sent_start_end_indices = list(
@@ -121,112 +148,124 @@ class PubTatorDocument:
                         self.sent_start_end_indices[i + 1:])
                 break
 
-        self.sentences = [self.title]
-        self.sentences.extend(sentence_tok.tokenize(self.abstract))
-        self.sentences = [self.tokenizer.tokenize(sentence)
-                          for sentence in self.sentences]
+        if pretokenized is None:
+            self.text, token_spans =\
+                self._tokenize_with_offsets(self.raw_text)
+        else:
+            self.text, token_spans = pretokenized
+        self.tokenization = tokenizer.tokenization
+        self._initialize_targets(token_spans)
+
+        # The tokens of a sentence are a contiguous slice of
+        # self.text, so rather than running the tokenizer a second
+        # time on each sentence, we cut the token list at the sentence
+        # boundaries: a token belongs to the sentence that ends after
+        # the token starts.
+        sent_ends = np.fromiter(
+            (end for _, end in self.sent_start_end_indices),
+            dtype=np.int32, count=len(self.sent_start_end_indices))
+        boundaries = np.searchsorted(self.token_char_starts, sent_ends)
+        if len(boundaries):
+            # any stray trailing tokens go to the last sentence
+            boundaries[-1] = len(self.text)
+        self.sentences = [self.text[start:stop]
+                          for start, stop in zip([0, *boundaries[:-1]],
+                                                 boundaries)]
         # for example, if tokenization is wordpiece, self.sentences is now
         # of the form [['Title'], ['Abs', '##tract', '.'], ['Stuff', '.']]
 
-        self.text = self.tokenizer.tokenize(self.raw_text)
-        self.tokenization = tokenizer.tokenization
-        self._initialize_targets()
-
         # list of all start and end indices of all entities
         # originally the stop index is exclusive, but we need it
         # to be inclusive and vice-versa for the start index.
-        self.start_end_indices = list(itertools.chain(
-            [(e.start_idx - 1, e.stop_idx - 1) for e in self.umls_entities]))
+        self.start_end_indices = [(e.start_idx - 1, e.stop_idx - 1)
+                                  for e in self.umls_entities]
 
-    def _initialize_targets(self):
-        char_level_targets = [None] * len(self.raw_text)
-        for i in range(len(char_level_targets)):
-            for e in self.umls_entities:
-                if i >= e.start_idx and i < e.stop_idx:
-                    char_level_targets[i] = e.cui, e.semantic_type_ID
-                    continue
-                elif i > e.stop_idx:
-                    continue
+    def _tokenize_with_offsets(self, text):
+        """ Tokenizes text, recovering the character span of each
+            token.
+            Return:
+                - tokens (list<str>)
+                - spans (list<(int, int)>): (start, stop) character
+                    index pairs locating each token in text.
+            Raises:
+                ValueError: if the tokenizer neither reports offsets
+                    nor produces tokens that are substrings of the
+                    text.
+        """
+        if hasattr(self.tokenizer, 'tokenize_with_offsets'):
+            return self.tokenizer.tokenize_with_offsets(text)
+        if getattr(self.tokenizer, 'is_fast', False):
+            # huggingface fast tokenizers compute offsets natively
+            encoding = self.tokenizer(text, add_special_tokens=False,
+                                      return_offsets_mapping=True)
+            tokens = self.tokenizer.convert_ids_to_tokens(
+                encoding['input_ids'])
+            return tokens, encoding['offset_mapping']
+        # generic fallback for tokenizers that only implement
+        # tokenize(): recover spans by scanning for each token in
+        # order. This works whenever tokens are substrings of the
+        # text, i.e. the tokenizer does not rewrite what it splits.
+        tokens = self.tokenizer.tokenize(text)
+        spans = []
+        pos = 0
+        for token in tokens:
+            start = text.find(token, pos)
+            if start == -1:
+                raise ValueError(
+                    "token {} not found in text: the tokenizer"
+                    " does not report offsets and its tokens cannot"
+                    " be located in the text".format(repr(token)))
+            pos = start + len(token)
+            spans.append((start, pos))
+        return tokens, spans
+
+    def _build_char_level_targets(self):
+        """ Builds the per-character label array: one label id per
+            character of raw_text, indexing into the document's table
+            of unique (CUI, semantic type) labels. Id 0 is reserved
+            for unannotated characters and maps to None.
+            The array is an intermediate of target alignment and is
+            not kept on the document -- at one entry per character of
+            every document it adds up to gigabytes on large corpora.
+            Use get_char_level_targets() to obtain it.
+        """
+        self._label_table = [None]
+        label_ids = {}
+        char_level_targets = np.zeros(len(self.raw_text), dtype=np.int16)
+        for e in self.umls_entities:
+            label = (e.cui, e.semantic_type_ID)
+            try:
+                label_id = label_ids[label]
+            except KeyError:
+                label_id = len(self._label_table)
+                label_ids[label] = label_id
+                self._label_table.append(label)
+            char_level_targets[e.start_idx:e.stop_idx] = label_id
+        return char_level_targets
+
+    def get_char_level_targets(self):
+        """ Recomputes and returns the per-character label id array
+            (see _build_char_level_targets). Rebuilding it from the
+            entity spans on request is cheap, whereas keeping one
+            around per document is not.
+        """
+        return self._build_char_level_targets()
 
-        token = iter(self.text)
-        concat_tokens = ''.join(self.text)
-        dmp = diff_match_patch()
-        diff = dmp.diff_main(self.raw_text, concat_tokens)
-        # this diff library creates diffs of the form:
-        #   [(flag, substring), (flag, substring), ...]
-        # where "flag" can be 1, -1 or 0 depending on whether
-        # the substring is in concat_tokens but not raw_text,
-        # vice-versa, or in both repectively.
-        # example:
-        #   raw_text = 'Nonylphenol'
-        #   concat_tokens = 'Non##yl##phe##no##l'
-        #   diff = [(0, 'Non'), (1, '##'), (0, 'yl'), (1, '##'),
-        #           (0, 'phe'), (1, '##'), (0, 'no'), (1, '##'), (0, 'l')]
-        # However, it is much easier to handle a character-level diff, e.g. :
-        #   [(0, 'N'), (0, 'o'), (0, 'n'), (1, '#'), (1, '#'), (0, 'y'), ...]
-        # This is what we set out to do with the following list
-        # comprehension, which may seem obscure, but it is 30%
-        # faster than the equivalent loop, which can be written as:
-        # new_diff = []
-        # for flag, sub_str in diff:
-        #     new_diff += list(zip([flag] * len(sub_str), sub_str))
-        # diff = new_diff
-        #
-        # diff = list(itertools.chain(*[zip([a] * len(b), b)
-        #                               for a, b in diff]))
-        #
-        # In actuality, once we have a sequence of numbers that tell us
-        # whether a character comes from one string, the other or both, the
-        # character itself is redundant information. Removing it from
-        # consideration further divides execution time by 2.
-        diff = list(itertools.chain(*[[flag] * len(sub_str)
-                                      for flag, sub_str in diff]))
+    def _initialize_targets(self, token_spans):
+        char_level_targets = self._build_char_level_targets()
 
-        # initializing the targets for each token as None
-        token_targets = [None] * len(self.text)
-        # This helps us keep track of where we are within the current token
-        # so that we know when to move on to the next token
-        chars_left_in_current_token = len(next(token))
-        # Index of the currently tracked character in the raw_text, which
-        # always refers (if possible) to the same character as the character
-        # defined by chars_left_in_current_token. I'm not completely certain
-        # why it needs to start at -1 rather than 0, it just works.
-        current_char_index = -1
-        current_token_index = 0
-        # we maintain a lookup table of tokens to characters for the purpose
-        # of versatility.
-        self.token_to_char_lookup = {current_token_index: []}
-        for flag in diff:
-            # hypothetically, we can choose any time to assign the
-            # token's label but we choose to do so when we're on the
-            # last character of the current token.
-            if chars_left_in_current_token == 0:
-                token_targets[current_token_index] =\
-                    char_level_targets[current_char_index]
-                current_token_index += 1
-                # We also add the current token to the lookup table
-                self.token_to_char_lookup[current_token_index] = []
-                chars_left_in_current_token = len(next(token))
-            # we're pointing to the same character in both the
-            # raw_text and the tokenized text, so update both
-            # pointers for the next iteration
-            if flag == 0:
-                current_char_index += 1
-                # we add the current character index to the lookup table
-                self.token_to_char_lookup[current_token_index].append(
-                    current_char_index)
-                chars_left_in_current_token -= 1
-            # we're on a character missing in the tokenized text,
-            # so we skip it
-            elif flag == -1:
-                current_char_index += 1
-                # we do not add the current character index to the lookup
-                # table, since it is not in the tokens
-            # we're on a character missing in the raw_text, so we skip it
-            else:
-                chars_left_in_current_token -= 1
-        self.char_level_targets = char_level_targets
-        self.targets = token_targets
+        # With the character span of every token known, each token
+        # takes the label of its first character. The spans themselves
+        # are kept as two flat arrays rather than a dict of per-token
+        # character lists: token i covers characters
+        # token_char_starts[i] to token_char_ends[i] (exclusive).
+        span_arr = np.array(token_spans, dtype=np.int32).reshape(-1, 2)
+        self.token_char_starts = span_arr[:, 0]
+        self.token_char_ends = span_arr[:, 1]
+        # fancy indexing gathers every token's label id in one C-level
+        # pass; only the table lookup remains in Python
+        label_ids = char_level_targets[self.token_char_starts]
+        self.targets = [self._label_table[i] for i in label_ids]
 
     def get_vocab(self):
         try:
@@ -1,10 +1,14 @@
 import pickle
+import re
 import string
 
 from abc import abstractmethod
 from enum import Enum
-from nltk.tokenize import TweetTokenizer
-from transformers import BertTokenizer
+from transformers import BertTokenizerFast
+
+# frozenset gives O(1) membership tests, vs. a substring scan of
+# string.punctuation on every token
+_PUNCT = frozenset(string.punctuation)
 
 
 class TokenType(Enum):
@@ -95,13 +99,10 @@ class BaseTokenizer:
         return decoded
 
     def _encode_decode(self, input_txt, converter, default_value):
-        output_text = []
-        for token in input_txt:
-            try:
-                output_text.append(converter[token])
-            except KeyError:
-                output_text.append(default_value)
-        return output_text
+        # dict.get keeps unknown-token handling on the C side instead
+        # of raising and catching a KeyError per unknown token
+        get = converter.get
+        return [get(token, default_value) for token in input_txt]
 
 
 class CharTokenizer(BaseTokenizer):
@@ -115,29 +116,53 @@ class CharTokenizer(BaseTokenizer):
     def tokenize(self, text):
         return list(text)
 
+    def tokenize_with_offsets(self, text):
+        """ Tokenizes text and returns the tokens along with the
+            (start, stop) character span of each token in the text.
+            For characters the spans are trivially (i, i + 1).
+        """
+        return list(text), [(i, i + 1) for i in range(len(text))]
+
     def detokenize(self, tokenized_txt):
         return ''.join(tokenized_txt)
 
 
 class WordTokenizer(BaseTokenizer):
-    """ Word-level tokenizer, uses NLTK's tweet tokenizer to separate words.
+    """ Word-level tokenizer. Splits text into runs of word characters
+        and single punctuation marks with a precompiled regex, which is
+        considerably faster than NLTK's Python-level tokenizers and
+        never rewrites the text, so every token is an exact substring
+        of the input.
     """
 
     def __init__(self, vocab_fname):
         super().__init__(vocab_fname)
         self.tokenization = TokenType.WORD
-        self.tknzr = TweetTokenizer()
+        self._tok_re = re.compile(r"\w+|[^\w\s]")
 
     def tokenize(self, text):
-        return self.tknzr.tokenize(text)
+        return self._tok_re.findall(text)
+
+    def tokenize_with_offsets(self, text):
+        """ Tokenizes text and returns the tokens along with the
+            (start, stop) character span of each token in the text.
+            A single pass of the tokenizing regex yields the tokens
+            and their positions together.
+        """
+        tokens = []
+        spans = []
+        for match in self._tok_re.finditer(text):
+            tokens.append(match.group())
+            spans.append((match.start(), match.end()))
+        return tokens, spans
 
     def detokenize(self, tokenized_txt):
-        detok_txt = ''
+        parts = []
         for tok in tokenized_txt:
-            detok_txt += tok
-            if tok not in string.punctuation:
-                detok_txt += ' '
-        return detok_txt
+            parts.append(tok)
+            if tok not in _PUNCT:
+                parts.append(' ')
+        return ''.join(parts)
 
 
 def get_tokenizer(tokenization, vocab):
@@ -146,7 +171,10 @@ def get_tokenizer(tokenization, vocab):
     if tokenization == TokenType.CHAR:
         return CharTokenizer(vocab)
     elif tokenization == TokenType.WP:
-        tok = BertTokenizer.from_pretrained(vocab)
+        # the fast (Rust-backed) tokenizer can report character
+        # offsets, which PubTatorDocument uses to align tokens with
+        # entity mentions without diffing.
+        tok = BertTokenizerFast.from_pretrained(vocab)
         tok.tokenization = TokenType.WP
         return tok
     else:
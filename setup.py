@@ -22,7 +22,7 @@ setuptools.setup(
     python_requires='>=3.6',
     install_requires=[
         'nltk',
-        'diff_match_patch',
+        'numpy',
         'transformers',
     ],
 )